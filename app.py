@@ -1,9 +1,13 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+import click
 from database import db
 from models import Customer, Consumption, Billing, BillingPayment, Service, CustomerService
+from sqlalchemy import delete, func, insert, literal, select, text, true, update
+from sqlalchemy.orm.exc import StaleDataError
+import hashlib
 import random
-from datetime import datetime, timedelta
+from datetime import datetime
 import threading
 import time
 
@@ -22,6 +26,79 @@ db.init_app(app)
 with app.app_context():
     db.create_all()
 
+# -----------------------
+# ETAGS A PARTIR DE VERSIONES
+# -----------------------
+def make_etag(kind, key, version):
+    """ETag fuerte derivado del contador de versión, sin serializar el cuerpo"""
+    return f"{kind}-{key}-v{version}"
+
+def current_etag(model, kind, key):
+    """Calcula el ETag actual consultando solo la columna de versión"""
+    version = db.session.query(model.version).filter(model.id == key).scalar()
+    if version is None:
+        return None
+    return make_etag(kind, key, version)
+
+def realtime_etag(customer_id):
+    """ETag del snapshot en tiempo real a partir de las versiones de sus filas.
+
+    Se envía como validador débil: el cuerpo incluye un timestamp por petición.
+    """
+    customer_version = db.session.query(Customer.version).filter_by(id=customer_id).scalar()
+    if customer_version is None:
+        return None
+
+    consumption_versions = db.session.query(Consumption.id, Consumption.version).filter_by(
+        customer_id=customer_id
+    ).order_by(Consumption.id).all()
+    billing_versions = db.session.query(Billing.id, Billing.version).filter_by(
+        customer_id=customer_id
+    ).order_by(Billing.id).all()
+    service_versions = db.session.query(Service.id, Service.version).join(
+        CustomerService, CustomerService.service_id == Service.id
+    ).filter(CustomerService.customer_id == customer_id).order_by(Service.id).all()
+    # Los pagos no tienen versión: se toman los campos del último pago que se muestra
+    last_payment = None
+    if billing_versions:
+        last_payment = db.session.query(
+            BillingPayment.id, BillingPayment.amount, BillingPayment.payment_date, BillingPayment.method
+        ).filter_by(billing_id=billing_versions[0][0]).order_by(
+            BillingPayment.payment_date.desc(), BillingPayment.id.desc()
+        ).first()
+
+    fingerprint = repr((
+        customer_version,
+        [tuple(row) for row in consumption_versions],
+        [tuple(row) for row in billing_versions],
+        [tuple(row) for row in service_versions],
+        tuple(last_payment) if last_payment else None
+    ))
+    digest = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:16]
+    return f"realtime-{customer_id}-{digest}"
+
+def json_with_etag(payload, etag, status=200, weak=False):
+    response = jsonify(payload)
+    response.status_code = status
+    if etag:
+        response.set_etag(etag, weak=weak)
+    return response
+
+def not_modified(etag, weak=False):
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=weak)
+    return response
+
+def precondition_failed(etag):
+    return json_with_etag({"error": "Precondition failed: resource was modified"}, etag, 412)
+
+def if_match_failed(etag):
+    """True si el cliente envió If-Match y no coincide con la versión actual"""
+    return bool(request.if_match) and not request.if_match.contains(etag)
+
+# Reintentos ante conflictos de versión (concurrencia optimista)
+STALE_RETRY_ATTEMPTS = 3
+
 # -----------------------
 # ENDPOINTS PARA TIEMPO REAL
 # -----------------------
@@ -30,6 +107,13 @@ with app.app_context():
 def get_customer_realtime_data(customer_id):
     """Endpoint consolidado para obtener todos los datos del cliente en tiempo real"""
     try:
+        # Validar caché del cliente solo con versiones
+        etag = realtime_etag(customer_id)
+        if etag is None:
+            return jsonify({"error": "Customer not found"}), 404
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag, weak=True)
+
         # Obtener datos del cliente
         customer = Customer.query.get(customer_id)
         if not customer:
@@ -39,7 +123,7 @@ def get_customer_realtime_data(customer_id):
         consumptions = Consumption.query.filter_by(customer_id=customer_id).all()
         
         # Obtener facturación
-        billing = Billing.query.filter_by(customer_id=customer_id).first()
+        billing = Billing.query.filter_by(customer_id=customer_id).order_by(Billing.id).first()
         
         # Obtener servicios del cliente
         customer_services = db.session.query(CustomerService.service_id).filter_by(customer_id=customer_id).all()
@@ -49,7 +133,9 @@ def get_customer_realtime_data(customer_id):
         # Obtener último pago si existe
         last_payment = None
         if billing:
-            payment = BillingPayment.query.filter_by(billing_id=billing.id).order_by(BillingPayment.payment_date.desc()).first()
+            payment = BillingPayment.query.filter_by(billing_id=billing.id).order_by(
+                BillingPayment.payment_date.desc(), BillingPayment.id.desc()
+            ).first()
             if payment:
                 last_payment = {
                     "amount": float(payment.amount),
@@ -113,7 +199,7 @@ def get_customer_realtime_data(customer_id):
             "status": s.status
         } for s in services]
 
-        return jsonify(response)
+        return json_with_etag(response, etag, weak=True)
 
     except Exception as e:
         return jsonify({"error": f"Error fetching realtime data: {str(e)}"}), 500
@@ -122,36 +208,44 @@ def get_customer_realtime_data(customer_id):
 def simulate_usage(customer_id):
     """Simular uso de datos, minutos y SMS para mostrar tiempo real"""
     try:
-        # Obtener consumos actuales
-        consumptions = Consumption.query.filter_by(customer_id=customer_id).all()
+        for attempt in range(STALE_RETRY_ATTEMPTS):
+            # Obtener consumos actuales
+            consumptions = Consumption.query.filter_by(customer_id=customer_id).all()
         
-        updates = []
-        for consumption in consumptions:
-            if consumption.type == 'data':
-                # Simular uso de datos (0.1 - 0.5 GB)
-                additional_usage = round(random.uniform(0.1, 0.5), 2)
-                new_used = min(consumption.used + additional_usage, consumption.total)
-                consumption.used = new_used
-                consumption.percentage = round((new_used / consumption.total) * 100, 1)
-                updates.append(f"Data: +{additional_usage}GB")
+            updates = []
+            for consumption in consumptions:
+                if consumption.type == 'data':
+                    # Simular uso de datos (0.1 - 0.5 GB)
+                    additional_usage = round(random.uniform(0.1, 0.5), 2)
+                    new_used = min(consumption.used + additional_usage, consumption.total)
+                    consumption.used = new_used
+                    consumption.percentage = round((new_used / consumption.total) * 100, 1)
+                    updates.append(f"Data: +{additional_usage}GB")
                 
-            elif consumption.type == 'minutes':
-                # Simular uso de minutos (5 - 15 min)
-                additional_minutes = random.randint(5, 15)
-                new_used = min(consumption.used + additional_minutes, consumption.total)
-                consumption.used = new_used
-                consumption.percentage = round((new_used / consumption.total) * 100, 1)
-                updates.append(f"Minutes: +{additional_minutes}min")
+                elif consumption.type == 'minutes':
+                    # Simular uso de minutos (5 - 15 min)
+                    additional_minutes = random.randint(5, 15)
+                    new_used = min(consumption.used + additional_minutes, consumption.total)
+                    consumption.used = new_used
+                    consumption.percentage = round((new_used / consumption.total) * 100, 1)
+                    updates.append(f"Minutes: +{additional_minutes}min")
                 
-            elif consumption.type == 'sms':
-                # Simular uso de SMS (1 - 3 SMS)
-                additional_sms = random.randint(1, 3)
-                new_used = min(consumption.used + additional_sms, consumption.total)
-                consumption.used = new_used
-                consumption.percentage = round((new_used / consumption.total) * 100, 1)
-                updates.append(f"SMS: +{additional_sms}")
+                elif consumption.type == 'sms':
+                    # Simular uso de SMS (1 - 3 SMS)
+                    additional_sms = random.randint(1, 3)
+                    new_used = min(consumption.used + additional_sms, consumption.total)
+                    consumption.used = new_used
+                    consumption.percentage = round((new_used / consumption.total) * 100, 1)
+                    updates.append(f"SMS: +{additional_sms}")
 
-        db.session.commit()
+            try:
+                db.session.commit()
+                break
+            except StaleDataError:
+                # Otro proceso cambió los consumos: releer y reintentar
+                db.session.rollback()
+        else:
+            return jsonify({"error": "Consumption changed concurrently, please retry"}), 409
         
         return jsonify({
             "message": "Usage simulated successfully",
@@ -167,16 +261,20 @@ def simulate_usage(customer_id):
 def reset_consumption(customer_id):
     """Resetear el consumo del cliente (simular nuevo ciclo)"""
     try:
-        consumptions = Consumption.query.filter_by(customer_id=customer_id).all()
-        
-        for consumption in consumptions:
-            consumption.used = 0
-            consumption.percentage = 0
-            # Actualizar fecha de reset al próximo mes
-            consumption.reset_date = datetime.now() + timedelta(days=30)
-
+        # Mismo avance que el ciclo: un mes desde hoy, en el día de anclaje del consumo
+        today = datetime.now().date()
+        anchor = func.coalesce(Consumption.reset_day, func.day(func.coalesce(Consumption.reset_date, today)))
+        db.session.execute(update(Consumption).where(
+            Consumption.customer_id == customer_id
+        ).ordered_values(
+            (Consumption.reset_day, anchor),
+            (Consumption.reset_date, next_cycle_date(literal(today), anchor)),
+            (Consumption.used, 0),
+            (Consumption.percentage, 0),
+            (Consumption.version, Consumption.version + 1)
+        ).execution_options(synchronize_session=False))
         db.session.commit()
-        
+
         return jsonify({
             "message": "Consumption reset successfully",
             "timestamp": datetime.now().isoformat()
@@ -228,33 +326,54 @@ def customer_list():
 
 @app.route('/customers/<string:customer_id>', methods=['GET', 'PUT', 'DELETE'])
 def customer_detail(customer_id):
+    if request.method == 'GET':
+        etag = current_etag(Customer, 'customer', customer_id)
+        if etag is None:
+            return jsonify({"error": "Customer not found"}), 404
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
     customer = Customer.query.get(customer_id)
     if not customer:
         return jsonify({"error": "Customer not found"}), 404
+    etag = make_etag('customer', customer.id, customer.version)
 
     if request.method == 'GET':
-        return jsonify({
+        return json_with_etag({
             "id": customer.id,
             "name": customer.name,
             "email": customer.email,
             "phone": customer.phone,
             "plan": customer.plan,
             "status": customer.status
-        })
+        }, etag)
 
     if request.method == 'PUT':
+        if if_match_failed(etag):
+            return precondition_failed(etag)
         data = request.get_json()
         customer.name = data.get('name', customer.name)
         customer.email = data.get('email', customer.email)
         customer.phone = data.get('phone', customer.phone)
         customer.plan = data.get('plan', customer.plan)
         customer.status = data.get('status', customer.status)
-        db.session.commit()
-        return jsonify({"message": "Customer updated"})
+        try:
+            db.session.commit()
+        except StaleDataError:
+            # Otra escritura cambió la versión entre la lectura y el UPDATE
+            db.session.rollback()
+            return precondition_failed(current_etag(Customer, 'customer', customer_id))
+        return json_with_etag({"message": "Customer updated"}, make_etag('customer', customer.id, customer.version))
 
     if request.method == 'DELETE':
+        if if_match_failed(etag):
+            return precondition_failed(etag)
         db.session.delete(customer)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return precondition_failed(current_etag(Customer, 'customer', customer_id))
         return jsonify({"message": "Customer deleted"})
 
 # -----------------------
@@ -284,12 +403,20 @@ def consumption_list():
 
 @app.route('/consumptions/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 def consumption_detail(id):
+    if request.method == 'GET':
+        etag = current_etag(Consumption, 'consumption', id)
+        if etag is None:
+            return jsonify({"error": "Consumption not found"}), 404
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
     c = Consumption.query.get(id)
     if not c:
         return jsonify({"error": "Consumption not found"}), 404
+    etag = make_etag('consumption', c.id, c.version)
 
     if request.method == 'GET':
-        return jsonify({
+        return json_with_etag({
             "id": c.id,
             "customer_id": c.customer_id,
             "type": c.type,
@@ -298,19 +425,34 @@ def consumption_detail(id):
             "unit": c.unit,
             "percentage": float(c.percentage) if c.percentage else None,
             "reset_date": str(c.reset_date)
-        })
+        }, etag)
 
     if request.method == 'PUT':
+        if if_match_failed(etag):
+            return precondition_failed(etag)
         data = request.get_json()
         for field in ['customer_id', 'type', 'used', 'total', 'unit', 'percentage', 'reset_date']:
             if field in data:
                 setattr(c, field, data[field])
-        db.session.commit()
-        return jsonify({"message": "Consumption updated"})
+        if 'reset_date' in data:
+            # Fecha movida a mano: el próximo ciclo toma su día como nuevo anclaje
+            c.reset_day = None
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return precondition_failed(current_etag(Consumption, 'consumption', id))
+        return json_with_etag({"message": "Consumption updated"}, make_etag('consumption', c.id, c.version))
 
     if request.method == 'DELETE':
+        if if_match_failed(etag):
+            return precondition_failed(etag)
         db.session.delete(c)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return precondition_failed(current_etag(Consumption, 'consumption', id))
         return jsonify({"message": "Consumption deleted"})
 
 # -----------------------
@@ -338,31 +480,54 @@ def billing_list():
 
 @app.route('/billings/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 def billing_detail(id):
+    if request.method == 'GET':
+        etag = current_etag(Billing, 'billing', id)
+        if etag is None:
+            return jsonify({"error": "Billing not found"}), 404
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
     b = Billing.query.get(id)
     if not b:
         return jsonify({"error": "Billing not found"}), 404
+    etag = make_etag('billing', b.id, b.version)
 
     if request.method == 'GET':
-        return jsonify({
+        return json_with_etag({
             "id": b.id,
             "customer_id": b.customer_id,
             "current_balance": float(b.current_balance) if b.current_balance else None,
             "currency": b.currency,
             "next_bill_date": str(b.next_bill_date),
             "monthly_fee": float(b.monthly_fee) if b.monthly_fee else None
-        })
+        }, etag)
 
     if request.method == 'PUT':
+        if if_match_failed(etag):
+            return precondition_failed(etag)
         data = request.get_json()
         for field in ['customer_id', 'current_balance', 'currency', 'next_bill_date', 'monthly_fee']:
             if field in data:
                 setattr(b, field, data[field])
-        db.session.commit()
-        return jsonify({"message": "Billing updated"})
+        if 'next_bill_date' in data:
+            # Fecha movida a mano: el próximo ciclo toma su día como nuevo anclaje
+            b.billing_day = None
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return precondition_failed(current_etag(Billing, 'billing', id))
+        return json_with_etag({"message": "Billing updated"}, make_etag('billing', b.id, b.version))
 
     if request.method == 'DELETE':
+        if if_match_failed(etag):
+            return precondition_failed(etag)
         db.session.delete(b)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return precondition_failed(current_etag(Billing, 'billing', id))
         return jsonify({"message": "Billing deleted"})
 
 # -----------------------
@@ -438,29 +603,49 @@ def service_list():
 
 @app.route('/services/<string:id>', methods=['GET', 'PUT', 'DELETE'])
 def service_detail(id):
+    if request.method == 'GET':
+        etag = current_etag(Service, 'service', id)
+        if etag is None:
+            return jsonify({"error": "Service not found"}), 404
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
     s = Service.query.get(id)
     if not s:
         return jsonify({"error": "Service not found"}), 404
+    etag = make_etag('service', s.id, s.version)
 
     if request.method == 'GET':
-        return jsonify({
+        return json_with_etag({
             "id": s.id,
             "name": s.name,
             "description": s.description,
             "status": s.status
-        })
+        }, etag)
 
     if request.method == 'PUT':
+        if if_match_failed(etag):
+            return precondition_failed(etag)
         data = request.get_json()
         for field in ['name', 'description', 'status']:
             if field in data:
                 setattr(s, field, data[field])
-        db.session.commit()
-        return jsonify({"message": "Service updated"})
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return precondition_failed(current_etag(Service, 'service', id))
+        return json_with_etag({"message": "Service updated"}, make_etag('service', s.id, s.version))
 
     if request.method == 'DELETE':
+        if if_match_failed(etag):
+            return precondition_failed(etag)
         db.session.delete(s)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            return precondition_failed(current_etag(Service, 'service', id))
         return jsonify({"message": "Service deleted"})
 
 # -----------------------
@@ -491,6 +676,132 @@ def customer_service_detail(customer_id, service_id):
     db.session.commit()
     return jsonify({"message": "Service unassigned from customer"})
 
+BULK_CHUNK_SIZE = 5000
+BULK_CUSTOMER_FILTERS = ('plan', 'status')
+
+def parse_string_list(data, key):
+    value = data.get(key)
+    if not isinstance(value, list) or not value or not all(isinstance(v, str) for v in value):
+        raise ValueError(f"{key} must be a non-empty list of strings")
+    return list(dict.fromkeys(value))
+
+def parse_bulk_selection(data):
+    """Valida el cuerpo de las operaciones masivas y devuelve (service_ids, customer_ids, filters)"""
+    if not isinstance(data, dict):
+        raise ValueError("JSON object body is required")
+    service_ids = parse_string_list(data, 'service_ids')
+
+    has_ids = 'customer_ids' in data
+    has_filter = 'filter' in data
+    if has_ids == has_filter:
+        raise ValueError("exactly one of customer_ids or filter (plan/status) is required")
+
+    if has_ids:
+        return service_ids, parse_string_list(data, 'customer_ids'), None
+
+    filters = data['filter']
+    if not isinstance(filters, dict) or not filters:
+        raise ValueError("filter must be a non-empty object")
+    unknown = [k for k in filters if k not in BULK_CUSTOMER_FILTERS]
+    if unknown:
+        raise ValueError(f"Unknown filter keys: {', '.join(unknown)} (allowed: {', '.join(BULK_CUSTOMER_FILTERS)})")
+    if not all(isinstance(v, str) for v in filters.values()):
+        raise ValueError("filter values must be strings")
+    return service_ids, None, filters
+
+def customer_id_chunks(customer_ids, filters, chunk_size=BULK_CHUNK_SIZE):
+    """Genera (ids existentes, ids no encontrados) por bloques, de la lista recibida o por filtro"""
+    if customer_ids:
+        for start in range(0, len(customer_ids), chunk_size):
+            requested = customer_ids[start:start + chunk_size]
+            existing = [row[0] for row in db.session.query(Customer.id).filter(Customer.id.in_(requested)).all()]
+            yield existing, len(requested) - len(existing)
+        return
+
+    # Keyset sobre la PK: todos los ids devueltos existen
+    last_id = None
+    while True:
+        query = db.session.query(Customer.id).filter_by(**filters)
+        if last_id is not None:
+            query = query.filter(Customer.id > last_id)
+        ids = [row[0] for row in query.order_by(Customer.id).limit(chunk_size).all()]
+        if not ids:
+            return
+        yield ids, 0
+        last_id = ids[-1]
+
+@app.route('/customer_services/bulk-assign', methods=['POST'])
+def customer_service_bulk_assign():
+    """Asignar servicios a muchos clientes con INSERT ... SELECT por bloques"""
+    try:
+        service_ids, customer_ids, filters = parse_bulk_selection(request.get_json(silent=True))
+
+        known_services = {row[0] for row in db.session.query(Service.id).filter(Service.id.in_(service_ids)).all()}
+        missing = [s for s in service_ids if s not in known_services]
+        if missing:
+            return jsonify({"error": f"Service not found: {', '.join(missing)}"}), 404
+
+        totals = {"customers": 0, "not_found": 0, "assigned": 0, "skipped": 0, "chunks": 0}
+        for chunk, not_found in customer_id_chunks(customer_ids, filters):
+            totals["not_found"] += not_found
+            if not chunk:
+                continue
+            already_assigned = select(CustomerService.customer_id).where(
+                CustomerService.customer_id == Customer.id,
+                CustomerService.service_id == Service.id
+            ).exists()
+            assigned = db.session.execute(insert(CustomerService).from_select(
+                ['customer_id', 'service_id'],
+                select(Customer.id, Service.id).join(Service, true()).where(
+                    Customer.id.in_(chunk),
+                    Service.id.in_(service_ids),
+                    ~already_assigned
+                )
+            )).rowcount
+            db.session.commit()
+
+            totals["chunks"] += 1
+            totals["customers"] += len(chunk)
+            totals["assigned"] += assigned
+            totals["skipped"] += len(chunk) * len(service_ids) - assigned
+
+        return jsonify({"message": "Services assigned to customers", **totals})
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Error assigning services: {str(e)}"}), 500
+
+@app.route('/customer_services/bulk-unassign', methods=['POST'])
+def customer_service_bulk_unassign():
+    """Desasignar servicios de muchos clientes con DELETE ... WHERE por bloques"""
+    try:
+        service_ids, customer_ids, filters = parse_bulk_selection(request.get_json(silent=True))
+
+        totals = {"customers": 0, "not_found": 0, "unassigned": 0, "chunks": 0}
+        for chunk, not_found in customer_id_chunks(customer_ids, filters):
+            totals["not_found"] += not_found
+            if not chunk:
+                continue
+            unassigned = db.session.execute(delete(CustomerService).where(
+                CustomerService.customer_id.in_(chunk),
+                CustomerService.service_id.in_(service_ids)
+            ).execution_options(synchronize_session=False)).rowcount
+            db.session.commit()
+
+            totals["chunks"] += 1
+            totals["customers"] += len(chunk)
+            totals["unassigned"] += unassigned
+
+        return jsonify({"message": "Services unassigned from customers", **totals})
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Error unassigning services: {str(e)}"}), 500
+
 # -----------------------
 # ENDPOINTS DE RECARGA Y PAGOS
 # -----------------------
@@ -511,26 +822,34 @@ def recharge_customer_balance():
         if not customer:
             return jsonify({"error": "Customer not found"}), 404
 
-        # Obtener o crear facturación del cliente
-        billing = Billing.query.filter_by(customer_id=customer_id).first()
-        if not billing:
-            return jsonify({"error": "Billing record not found"}), 404
+        for attempt in range(STALE_RETRY_ATTEMPTS):
+            # Obtener o crear facturación del cliente
+            billing = Billing.query.filter_by(customer_id=customer_id).first()
+            if not billing:
+                return jsonify({"error": "Billing record not found"}), 404
         
-        # Actualizar saldo (convertir Decimal a float para evitar errores)
-        old_balance = float(billing.current_balance or 0)
-        new_balance = old_balance + amount
-        billing.current_balance = new_balance
+            # Actualizar saldo (convertir Decimal a float para evitar errores)
+            old_balance = float(billing.current_balance or 0)
+            new_balance = old_balance + amount
+            billing.current_balance = new_balance
         
-        # Crear registro de pago
-        payment = BillingPayment(
-            billing_id=billing.id,
-            amount=amount,
-            payment_date=datetime.now().date(),
-            method=method
-        )
+            # Crear registro de pago
+            payment = BillingPayment(
+                billing_id=billing.id,
+                amount=amount,
+                payment_date=datetime.now().date(),
+                method=method
+            )
         
-        db.session.add(payment)
-        db.session.commit()
+            db.session.add(payment)
+            try:
+                db.session.commit()
+                break
+            except StaleDataError:
+                # El ciclo de facturación u otra escritura cambió el saldo: releer y reintentar
+                db.session.rollback()
+        else:
+            return jsonify({"error": "Billing changed concurrently, please retry"}), 409
         
         return jsonify({
             "message": "Balance recharged successfully",
@@ -586,6 +905,123 @@ def get_payment_history(customer_id):
     except Exception as e:
         return jsonify({"error": f"Error fetching payment history: {str(e)}"}), 500
 
+# -----------------------
+# CICLO DE FACTURACIÓN
+# -----------------------
+BILLING_CYCLE_CHUNK_SIZE = 5000
+MONTHLY_FEE_METHOD = 'Cuota mensual'
+
+def next_cycle_date(column, anchor_day):
+    """Un mes después, en el día de anclaje o el último día del mes si es más corto.
+
+    Partir del anclaje evita la deriva de DATE_ADD: 31/01 -> 28/02 -> 31/03.
+    """
+    # Acotar el anclaje a 1..31: un valor fuera de rango nunca debe retrasar la fecha
+    anchor_day = func.least(func.greatest(anchor_day, 1), 31)
+    month_end = func.last_day(func.date_add(column, text('INTERVAL 1 MONTH')))
+    return func.subdate(month_end, func.greatest(func.day(month_end) - anchor_day, 0))
+
+def run_billing_cycle(cycle_date=None, chunk_size=BILLING_CYCLE_CHUNK_SIZE, dry_run=False):
+    """Cobra la cuota mensual de las cuentas vencidas y reinicia los consumos vencidos.
+
+    Trabaja por bloques con sentencias set-based y confirma cada bloque por
+    separado, así que puede relanzarse tras un fallo. Al cobrar se avanza
+    next_bill_date un mes, por lo que repetir el mismo ciclo no cobra dos veces;
+    los consumos se reinician según su propio reset_date, no el de facturación.
+    Con dry_run todo se ejecuta en una sola transacción que se deshace al final.
+    """
+    today = datetime.now().date()
+    cycle_date = cycle_date or today
+    if cycle_date > today:
+        raise ValueError("cycle_date cannot be in the future")
+
+    totals = {"accounts": 0, "charges": 0, "consumptions_reset": 0, "chunks": 0}
+    billing_anchor = func.coalesce(Billing.billing_day, func.day(Billing.next_bill_date))
+    consumption_anchor = func.coalesce(Consumption.reset_day, func.day(Consumption.reset_date))
+
+    try:
+        while True:
+            # Reclamar el bloque con bloqueo de filas: una ejecución concurrente espera
+            # y después vuelve a evaluar next_bill_date sobre lo ya confirmado
+            billing_ids = [row[0] for row in db.session.query(Billing.id).filter(
+                Billing.next_bill_date <= cycle_date
+            ).order_by(Billing.next_bill_date, Billing.id).limit(chunk_size).with_for_update().all()]
+            if not billing_ids:
+                break
+
+            claimed = Billing.id.in_(billing_ids)
+
+            # Cargos negativos con la fecha del ciclo cobrado, solo de las filas reclamadas
+            charges = db.session.execute(insert(BillingPayment).from_select(
+                ['billing_id', 'amount', 'payment_date', 'method'],
+                select(
+                    Billing.id, -Billing.monthly_fee, Billing.next_bill_date, literal(MONTHLY_FEE_METHOD)
+                ).where(claimed, Billing.monthly_fee > 0)
+            )).rowcount
+
+            # MySQL asigna de izquierda a derecha: el anclaje se fija antes de mover la fecha
+            accounts = db.session.execute(update(Billing).where(claimed).ordered_values(
+                (Billing.billing_day, billing_anchor),
+                (Billing.next_bill_date, next_cycle_date(Billing.next_bill_date, billing_anchor)),
+                (Billing.current_balance, func.coalesce(Billing.current_balance, 0) - func.coalesce(Billing.monthly_fee, 0)),
+                (Billing.version, Billing.version + 1)
+            ).execution_options(synchronize_session=False)).rowcount
+            if accounts != len(billing_ids):
+                raise RuntimeError(f"Billing cycle claimed {len(billing_ids)} accounts but advanced {accounts}")
+
+            if not dry_run:
+                db.session.commit()
+
+            totals["chunks"] += 1
+            totals["accounts"] += accounts
+            totals["charges"] += charges
+
+        while True:
+            # Consumos vencidos por su propio reset_date (índice), con el mismo reclamo por bloques
+            consumption_ids = [row[0] for row in db.session.query(Consumption.id).filter(
+                Consumption.reset_date <= cycle_date
+            ).order_by(Consumption.reset_date, Consumption.id).limit(chunk_size).with_for_update().all()]
+            if not consumption_ids:
+                break
+
+            resets = db.session.execute(update(Consumption).where(
+                Consumption.id.in_(consumption_ids)
+            ).ordered_values(
+                (Consumption.reset_day, consumption_anchor),
+                (Consumption.reset_date, next_cycle_date(Consumption.reset_date, consumption_anchor)),
+                (Consumption.used, 0),
+                (Consumption.percentage, 0),
+                (Consumption.version, Consumption.version + 1)
+            ).execution_options(synchronize_session=False)).rowcount
+            if resets != len(consumption_ids):
+                raise RuntimeError(f"Billing cycle claimed {len(consumption_ids)} consumptions but reset {resets}")
+
+            if not dry_run:
+                db.session.commit()
+
+            totals["chunks"] += 1
+            totals["consumptions_reset"] += resets
+    finally:
+        # Libera los bloqueos del último SELECT ... FOR UPDATE, o deshace el dry run
+        db.session.rollback()
+
+    return totals
+
+@app.cli.command('billing-cycle')
+@click.option('--date', 'cycle_date', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Fecha del ciclo (por defecto hoy, nunca futura)')
+@click.option('--chunk-size', type=click.IntRange(min=1), default=BILLING_CYCLE_CHUNK_SIZE)
+@click.option('--dry-run', is_flag=True, help='Ejecuta el ciclo en una transacción y la deshace al final')
+def billing_cycle_command(cycle_date, chunk_size, dry_run):
+    """Ejecutar el ciclo de facturación (ventana de mantenimiento)"""
+    cycle_date = cycle_date.date() if cycle_date else None
+    if cycle_date and cycle_date > datetime.now().date():
+        raise click.BadParameter("cycle date cannot be in the future", param_hint="'--date'")
+
+    totals = run_billing_cycle(cycle_date, chunk_size, dry_run=dry_run)
+    label = "Billing cycle dry run" if dry_run else "Billing cycle completed"
+    click.echo(f"[{datetime.now()}] {label}: {totals}")
+
 # -----------------------
 # FUNCIÓN PARA SIMULAR ACTUALIZACIONES AUTOMÁTICAS
 # -----------------------
@@ -595,9 +1031,10 @@ def auto_update_consumption():
         while True:
             try:
                 # Actualizar consumo cada 30 segundos para todos los clientes activos
-                customers = Customer.query.filter_by(status='active').all()
-                for customer in customers:
-                    consumptions = Consumption.query.filter_by(customer_id=customer.id).all()
+                customer_ids = [row[0] for row in db.session.query(Customer.id).filter_by(status='active').all()]
+                conflicts = 0
+                for customer_id in customer_ids:
+                    consumptions = Consumption.query.filter_by(customer_id=customer_id).all()
                     
                     for consumption in consumptions:
                         if consumption.used < consumption.total:
@@ -616,9 +1053,15 @@ def auto_update_consumption():
                             new_used = min(consumption.used + increment, consumption.total)
                             consumption.used = new_used
                             consumption.percentage = round((new_used / consumption.total) * 100, 1)
+
+                    # Confirmar por cliente: un conflicto de versión solo descarta ese cliente
+                    try:
+                        db.session.commit()
+                    except StaleDataError:
+                        db.session.rollback()
+                        conflicts += 1
                 
-                db.session.commit()
-                print(f"[{datetime.now()}] Auto-updated consumption data")
+                print(f"[{datetime.now()}] Auto-updated consumption data ({conflicts} skipped by concurrent changes)")
                 
             except Exception as e:
                 print(f"Error in auto-update: {e}")
@@ -641,6 +1084,8 @@ if __name__ == '__main__':
     print("   - POST /api/customer/{id}/reset-consumption - Reset consumo")
     print("   - POST /api/customer/recharge - Recargar saldo")
     print("   - GET /api/customer/{id}/payment-history - Historial de pagos")
+    print("   - POST /customer_services/bulk-assign - Asignación masiva de servicios")
+    print("   - POST /customer_services/bulk-unassign - Desasignación masiva de servicios")
     print("   - GET /api/health - Estado del sistema")
     
     app.run(debug=True, port=5000, host='0.0.0.0')
\ No newline at end of file
@@ -8,6 +8,9 @@ class Customer(db.Model):
     phone = db.Column(db.String(20))
     plan = db.Column(db.String(50))
     status = db.Column(db.Enum('active','inactive'), default='active')
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
 
     consumptions = db.relationship('Consumption', backref='customer', cascade="all, delete-orphan")
     billings = db.relationship('Billing', backref='customer', cascade="all, delete-orphan")
@@ -23,7 +26,11 @@ class Consumption(db.Model):
     total = db.Column(db.Numeric(10,2), nullable=False)
     unit = db.Column(db.String(10), nullable=False)
     percentage = db.Column(db.Numeric(5,2))
-    reset_date = db.Column(db.Date)
+    reset_date = db.Column(db.Date, index=True)
+    reset_day = db.Column(db.SmallInteger)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
 
 
 class Billing(db.Model):
@@ -32,8 +39,12 @@ class Billing(db.Model):
     customer_id = db.Column(db.String(20), db.ForeignKey('customers.id'))
     current_balance = db.Column(db.Numeric(10,2))
     currency = db.Column(db.String(10))
-    next_bill_date = db.Column(db.Date)
+    next_bill_date = db.Column(db.Date, index=True)
     monthly_fee = db.Column(db.Numeric(10,2))
+    billing_day = db.Column(db.SmallInteger)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
 
     payments = db.relationship('BillingPayment', backref='billing', cascade="all, delete-orphan")
 
@@ -53,6 +64,9 @@ class Service(db.Model):
     name = db.Column(db.String(50), nullable=False)
     description = db.Column(db.String(255))
     status = db.Column(db.Enum('active','inactive'), default='active')
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': version}
 
     customers = db.relationship('CustomerService', backref='service', cascade="all, delete-orphan")
 